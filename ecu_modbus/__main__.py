@@ -3,6 +3,18 @@ import json
 
 from . import apsystems_modbus
 
+# label, value register, scale factor register, format spec, divisor
+FIELDS = (
+    ("Temperature", "temperature", "temperature_scale", ".2f", 1),
+    ("Current", "current", "temperature_scale", ".2f", 10),
+    ("Voltage", "l1n_voltage", "voltage_scale", ".2f", 1),
+    ("Frequency", "frequency", "frequency_scale", ".3f", 1),
+    ("Power", "power_ac", "power_ac_scale", ".2f", 1),
+    ("Power (Apparent)", "power_apparent", "power_apparent_scale", ".2f", 1),
+    ("Power (Reactive)", "power_reactive", "power_reactive_scale", ".2f", 1),
+    ("Power Factor", "power_factor", "power_factor_scale", ".3f", 1),
+    ("Total Energy", "energy_total", "energy_total_scale", "", 1),
+)
 
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
@@ -37,37 +49,15 @@ if __name__ == "__main__":
 
         print(f"\tManufacturer: {values['c_manufacturer']}")
         print(f"\tModel: {values['c_model']}")
-        #  print(f"\tType: {apsystems_modbus.C_SUNSPEC_DID_MAP[str(values['c_sunspec_did'])]}")
+        #  print(f"\tType: {apsystems_modbus.C_SUNSPEC_DID_MAP.get(values['c_sunspec_did'], 'Unknown')}")
         print(f"\tVersion: {values['c_version']}")
         print(f"\tSerial: {values['c_serialnumber']}")
-        print(f"\tStatus: {apsystems_modbus.INVERTER_STATUS_MAP[values['status']]}")
-        print(
-            f"\tTemperature: {(values['temperature'] *(10 ** values['temperature_scale'])):.2f}{inverter.registers['temperature'][6]}"
-        )
+        print(f"\tStatus: {apsystems_modbus.INVERTER_STATUS_MAP.get(values['status'], 'Unknown')}")
 
-        print(
-            f"\tCurrent: {(values['current'] * (10 ** values['temperature_scale'])/10):.2f}{inverter.registers['current'][6]}"
-        )
+        for label, key, sk, fmt, divisor in FIELDS:
+            value = inverter.scaled(values, key, sk)
 
-        print(
-            f"\tVoltage: {(values['l1n_voltage'] * (10 ** values['voltage_scale'])):.2f}{inverter.registers['l1n_voltage'][6]}"
-        )
+            if divisor != 1:
+                value /= divisor
 
-        print(
-            f"\tFrequency: {(values['frequency'] * (10 ** values['frequency_scale'])):.3f}{inverter.registers['frequency'][6]}"
-        )
-        print(
-            f"\tPower: {(values['power_ac'] * (10 ** values['power_ac_scale'])):.2f}{inverter.registers['power_ac'][6]}"
-        )
-        print(
-            f"\tPower (Apparent): {(values['power_apparent'] * (10 ** values['power_apparent_scale'])):.2f}{inverter.registers['power_apparent'][6]}"
-        )
-        print(
-            f"\tPower (Reactive): {(values['power_reactive'] * (10 ** values['power_reactive_scale'])):.2f}{inverter.registers['power_reactive'][6]}"
-        )
-        print(
-            f"\tPower Factor: {(values['power_factor'] * (10 ** values['power_factor_scale'])):.3f}{inverter.registers['power_factor'][6]}"
-        )
-        print(
-            f"\tTotal Energy: {(values['energy_total'] * (10 ** values['energy_total_scale']))}{inverter.registers['energy_total'][6]}"
-        )
+            print(f"\t{label}: {format(value, fmt)}{inverter.registers[key][6]}")
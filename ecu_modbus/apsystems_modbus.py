@@ -1,9 +1,10 @@
 import enum
+import socket
+import struct
+import threading
 import time
 
-from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadBuilder
-from pymodbus.payload import BinaryPayloadDecoder
+from pymodbus.exceptions import ConnectionException
 from pymodbus.client import ModbusTcpClient
 from pymodbus.client import ModbusSerialClient
 from pymodbus.register_read_message import ReadHoldingRegistersResponse
@@ -64,29 +65,61 @@ SUNSPEC_NOT_IMPLEMENTED = {
     "STRING": "",
 }
 
+# Big-endian byte and word order, as used by all registers of the ECU.
+_STRUCTS = {
+    RegisterDataType.UINT16: struct.Struct(">H"),
+    RegisterDataType.UINT32: struct.Struct(">I"),
+    RegisterDataType.UINT64: struct.Struct(">Q"),
+    RegisterDataType.INT16: struct.Struct(">h"),
+    RegisterDataType.ACC32: struct.Struct(">I"),
+    RegisterDataType.FLOAT32: struct.Struct(">f"),
+    RegisterDataType.SEFLOAT: struct.Struct(">f"),
+}
+
+_DECODERS = {dtype: s.unpack_from for dtype, s in _STRUCTS.items()}
+
+# Powers of ten for SunSpec scale factors, which are small signed exponents.
+_POW10_INT = [10 ** i for i in range(13)]
+
 C_SUNSPEC_DID_MAP = {
-    "101": "Single Phase Inverter",
-    "102": "Split Phase Inverter",
-    "103": "Three Phase Inverter",
-    "201": "Single Phase Meter",
-    "202": "Split Phase Meter",
-    "203": "Wye 3P1N Three Phase Meter",
-    "204": "Delta 3P Three Phase Meter",
+    101: "Single Phase Inverter",
+    102: "Split Phase Inverter",
+    103: "Three Phase Inverter",
+    201: "Single Phase Meter",
+    202: "Split Phase Meter",
+    203: "Wye 3P1N Three Phase Meter",
+    204: "Delta 3P Three Phase Meter",
 }
 
-INVERTER_STATUS_MAP = [
-    "Undefined",
-    "Off",
-    "Sleeping",
-    "Grid Monitoring",
-    "Producing",
-    "Producing (Throttled)",
-    "Shutting Down",
-    "Fault",
-    "Standby",
-]
+INVERTER_STATUS_MAP = {
+    0: "Undefined",
+    1: "Off",
+    2: "Sleeping",
+    3: "Grid Monitoring",
+    4: "Producing",
+    5: "Producing (Throttled)",
+    6: "Shutting Down",
+    7: "Fault",
+    8: "Standby",
+}
 
 
+# Maximum number of registers in a single read request, per the Modbus spec.
+MODBUS_MAX_REGISTERS = 125
+
+# Holes of up to this many registers are read through rather than split into
+# a separate request, as an extra round-trip costs far more than a few dozen
+# unused words.
+REGISTER_GAP_THRESHOLD = 32
+
+# Keep idle TCP connections alive across polls (and NAT timeouts), in seconds.
+TCP_KEEPALIVE_IDLE = 30
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 3
+
+# Base delay before retrying a failed request, doubled on each attempt.
+RETRY_BACKOFF = 0.05
+
 METER_REGISTER_OFFSETS = [
     0x000,
     0x0AE,
@@ -94,13 +127,35 @@ METER_REGISTER_OFFSETS = [
 ]
 
 
+# Modbus TCP clients shared by all devices behind the same gateway, keyed by
+# (host, port, timeout), along with the lock serializing their requests.
+_CLIENT_POOL = {}
+_CLIENT_POOL_LOCK = threading.Lock()
+
+
+def _decode_string(data):
+    return data.decode(encoding="utf-8", errors="ignore").replace("\x00", "").rstrip()
+
+
+def _set_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    # Fine-grained tuning is only available on some platforms (e.g. Linux).
+    for option, value in (
+        ("TCP_KEEPIDLE", TCP_KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", TCP_KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", TCP_KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
 class APsystems:
 
     model = "APsystems"
     stopbits = 1
     parity = "N"
     baud = 115200
-    wordorder = Endian.BIG
 
     def __init__(
         self,
@@ -117,6 +172,7 @@ class APsystems:
     ):
         if parent:
             self.client = parent.client
+            self._lock = parent._lock
             self.mode = parent.mode
             self.timeout = parent.timeout
             self.retries = parent.retries
@@ -160,11 +216,21 @@ class APsystems:
                     baudrate=self.baud,
                     timeout=self.timeout,
                 )
+                self._lock = threading.RLock()
             else:
                 self.mode = ConnectionType.TCP
-                self.client = ModbusTcpClient(
-                    host=self.host, port=self.port, timeout=self.timeout
-                )
+                key = (self.host, self.port, self.timeout)
+
+                with _CLIENT_POOL_LOCK:
+                    if key not in _CLIENT_POOL:
+                        _CLIENT_POOL[key] = (
+                            ModbusTcpClient(
+                                host=self.host, port=self.port, timeout=self.timeout
+                            ),
+                            threading.RLock(),
+                        )
+
+                    self.client, self._lock = _CLIENT_POOL[key]
 
     def __repr__(self):
         if self.mode == ConnectionType.RTU:
@@ -175,168 +241,185 @@ class APsystems:
             return f"<{self.__class__.__module__}.{self.__class__.__name__} object at {hex(id(self))}>"
 
     def _read_holding_registers(self, address, length):
-        for i in range(self.retries):
-            if not self.connected():
-                self.connect()
-                time.sleep(0.1)
-                continue
+        with self._lock:
+            for i in range(self.retries):
+                try:
+                    self._ensure_connection()
 
-            result = self.client.read_holding_registers(address, length, slave=self.unit)
+                    result = self.client.read_holding_registers(address, length, slave=self.unit)
+                except (ConnectionException, OSError):
+                    result = None
 
-            if not isinstance(result, ReadHoldingRegistersResponse):
-                continue
-            if len(result.registers) != length:
-                continue
+                # pymodbus returns (rather than raises) timeouts and I/O errors,
+                # closing the transport when it gives up on it.
+                if result is None or (result.isError() and not self.connected()):
+                    self.disconnect()
 
-            return BinaryPayloadDecoder.fromRegisters(
-                result.registers, byteorder=Endian.BIG, wordorder=self.wordorder
-            )
+                    if i < self.retries - 1:
+                        time.sleep(RETRY_BACKOFF * (2 ** i))
+                    continue
+
+                if not isinstance(result, ReadHoldingRegistersResponse):
+                    continue
+                if len(result.registers) != length:
+                    continue
+
+                return struct.pack(f">{length}H", *result.registers)
 
-        return None
+            return None
 
     def _write_holding_register(self, address, value):
-        return self.client.write_registers(
-            address=address, values=value, unit=self.unit
-        )
+        with self._lock:
+            self._ensure_connection()
+
+            return self.client.write_registers(
+                address=address, values=value, unit=self.unit
+            )
 
     def _encode_value(self, data, dtype):
-        builder = BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=self.wordorder)
-
-        try:
-            if dtype == RegisterDataType.UINT16:
-                builder.add_16bit_uint(data)
-            elif dtype == RegisterDataType.UINT32:
-                builder.add_32bit_uint(data)
-            elif dtype == RegisterDataType.UINT64:
-                builder.add_64bit_uint(data)
-            elif dtype == RegisterDataType.INT16:
-                builder.add_16bit_int(data)
-            elif dtype == RegisterDataType.FLOAT32 or dtype == RegisterDataType.SEFLOAT:
-                builder.add_32bit_float(data)
-            elif dtype == RegisterDataType.STRING:
-                builder.add_string(data)
-            else:
-                raise NotImplementedError(dtype)
-
-        except NotImplementedError:
-            raise
-
-        return builder.to_registers()
-
-    def _decode_value(self, data, length, dtype, vtype):
-        try:
-            if dtype == RegisterDataType.UINT16:
-                decoded = data.decode_16bit_uint()
-            elif dtype == RegisterDataType.UINT32 or dtype == RegisterDataType.ACC32:
-                decoded = data.decode_32bit_uint()
-            elif dtype == RegisterDataType.UINT64:
-                decoded = data.decode_64bit_uint()
-            elif dtype == RegisterDataType.INT16:
-                decoded = data.decode_16bit_int()
-            elif dtype == RegisterDataType.FLOAT32 or dtype == RegisterDataType.SEFLOAT:
-                decoded = data.decode_32bit_float()
-            elif dtype == RegisterDataType.STRING:
-                decoded = (
-                    data.decode_string(length * 2)
-                    .decode(encoding="utf-8", errors="ignore")
-                    .replace("\x00", "")
-                    .rstrip()
-                )
-            else:
-                raise NotImplementedError(dtype)
+        if dtype == RegisterDataType.STRING:
+            encoded = data.encode(encoding="utf-8")
+            encoded = encoded.ljust(len(encoded) + len(encoded) % 2, b"\x00")
+        elif dtype in _STRUCTS:
+            encoded = _STRUCTS[dtype].pack(data)
+        else:
+            raise NotImplementedError(dtype)
 
-            if decoded == SUNSPEC_NOT_IMPLEMENTED[dtype.name]:
-                return vtype(False)
-            else:
-                return vtype(decoded)
-        except NotImplementedError:
-            raise
+        return list(struct.unpack(f">{len(encoded) // 2}H", encoded))
+
+    def _decode_value(self, data, offset, length, dtype, vtype):
+        unpack_from = _DECODERS.get(dtype)
+
+        if unpack_from is not None:
+            decoded = unpack_from(data, offset)[0]
+        elif dtype == RegisterDataType.STRING:
+            decoded = _decode_string(data[offset:offset + length * 2])
+        else:
+            raise NotImplementedError(dtype)
+
+        if decoded == SUNSPEC_NOT_IMPLEMENTED[dtype.name]:
+            return vtype(False)
+        else:
+            return vtype(decoded)
 
     def _read(self, value):
         address, length, rtype, dtype, vtype, label, fmt, batch = value
 
-        try:
-            if rtype == RegisterType.INPUT:
-                return self._decode_value(
-                    self._read_input_registers(address, length), length, dtype, vtype
-                )
-            elif rtype == RegisterType.HOLDING:
-                return self._decode_value(
-                    self._read_holding_registers(address, length), length, dtype, vtype
-                )
-            else:
-                raise NotImplementedError(rtype)
-        except NotImplementedError:
-            raise
-        except AttributeError:
+        if rtype == RegisterType.INPUT:
+            data = self._read_input_registers(address, length)
+        elif rtype == RegisterType.HOLDING:
+            data = self._read_holding_registers(address, length)
+        else:
+            raise NotImplementedError(rtype)
+
+        if not data:
             return False
 
-    def _read_all(self, values, rtype):
-        addr_min = False
-        addr_max = False
+        return self._decode_value(data, 0, length, dtype, vtype)
+
+    def _clusters(self, values):
+        clusters = []
 
         for k, v in values.items():
             v_addr = v[0]
-            v_length = v[1]
+            v_end = v[0] + v[1]
 
-            if addr_min is False:
-                addr_min = v_addr
-            if addr_max is False:
-                addr_max = v_addr + v_length
+            if clusters:
+                addr_min, addr_max, items = clusters[-1]
 
-            if v_addr < addr_min:
-                addr_min = v_addr
-            if (v_addr + v_length) > addr_max:
-                addr_max = v_addr + v_length
+                if (
+                    v_addr - addr_max <= REGISTER_GAP_THRESHOLD
+                    and v_end - addr_min <= MODBUS_MAX_REGISTERS
+                ):
+                    clusters[-1][1] = v_end
+                    items.append((k, v))
+                    continue
 
+            clusters.append([v_addr, v_end, [(k, v)]])
+
+        return clusters
+
+    def _plan(self, values):
+        plan = []
+
+        for addr_min, addr_max, items in self._clusters(values):
+            fields = []
+
+            for k, v in items:
+                address, length, rtype, dtype, vtype, label, fmt, batch = v
+
+                if dtype != RegisterDataType.STRING and dtype not in _DECODERS:
+                    raise NotImplementedError(dtype)
+
+                fields.append((
+                    k,
+                    (address - addr_min) * 2,
+                    length * 2,
+                    _DECODERS.get(dtype),
+                    vtype,
+                    SUNSPEC_NOT_IMPLEMENTED[dtype.name],
+                ))
+
+            plan.append((addr_min, addr_max - addr_min, fields))
+
+        return plan
+
+    def _read_all(self, plan, rtype):
         results = {}
-        offset = addr_min
-        length = addr_max - addr_min
 
-        try:
+        for address, length, fields in plan:
             if rtype == RegisterType.INPUT:
-                data = self._read_input_registers(offset, length)
+                data = self._read_input_registers(address, length)
             elif rtype == RegisterType.HOLDING:
-                data = self._read_holding_registers(offset, length)
+                data = self._read_holding_registers(address, length)
             else:
                 raise NotImplementedError(rtype)
 
             if not data:
-                return results
-
-            for k, v in values.items():
-                address, length, rtype, dtype, vtype, label, fmt, batch = v
+                continue
 
-                if address > offset:
-                    skip_bytes = address - offset
-                    offset += skip_bytes
-                    data.skip_bytes(skip_bytes * 2)
+            for k, offset, size, unpack_from, vtype, sentinel in fields:
+                if unpack_from is None:
+                    decoded = _decode_string(data[offset:offset + size])
+                else:
+                    decoded = unpack_from(data, offset)[0]
 
-                results[k] = self._decode_value(data, length, dtype, vtype)
-                offset += length
-        except NotImplementedError:
-            raise
+                results[k] = vtype(False) if decoded == sentinel else vtype(decoded)
 
         return results
 
     def _write(self, value, data):
         address, length, rtype, dtype, vtype, label, fmt, batch = value
 
-        try:
-            if rtype == RegisterType.HOLDING:
-                return self._write_holding_register(
-                    address, self._encode_value(data, dtype)
-                )
-            else:
-                raise NotImplementedError(rtype)
-        except NotImplementedError:
-            raise
+        if rtype == RegisterType.HOLDING:
+            return self._write_holding_register(
+                address, self._encode_value(data, dtype)
+            )
+        else:
+            raise NotImplementedError(rtype)
 
     def connect(self):
-        return self.client.connect()
+        with self._lock:
+            connected = self.client.connect()
+
+            if connected and self.mode is ConnectionType.TCP:
+                _set_keepalive(self.client.socket)
+
+            return connected
 
     def disconnect(self):
-        self.client.close()
+        with self._lock:
+            self.client.close()
+
+    def _ensure_connection(self):
+        if not self.connected():
+            self.connect()
+        elif self.mode is ConnectionType.TCP:
+            # pymodbus reconnects on its own after errors, without keepalive.
+            sock = self.client.socket
+
+            if not sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE):
+                _set_keepalive(sock)
 
     def connected(self):
         return self.client.is_socket_open()
@@ -353,26 +436,45 @@ class APsystems:
 
         return self._write(self.registers[key], data)
 
+    def scaled(self, values, key, scale_key=None):
+        value = values[key]
+        scale = values[scale_key or f"{key}_scale"]
+
+        if 0 <= scale < len(_POW10_INT):
+            return value * _POW10_INT[scale]
+        elif -len(_POW10_INT) < scale < 0:
+            return value / _POW10_INT[-scale]
+        else:
+            return value * 10 ** scale
+
     def read_all(self, rtype=RegisterType.HOLDING):
-        registers = {k: v for k, v in self.registers.items() if (v[2] == rtype)}
         results = {}
 
-        for batch in range(1, len(registers)):
-            register_batch = {k: v for k, v in registers.items() if (v[7] == batch)}
+        for plan in self._plans.get(rtype, {}).values():
+            results.update(self._read_all(plan, rtype))
 
-            if not register_batch:
-                break
+        return results
 
-            results.update(self._read_all(register_batch, rtype))
+    def _compile_registers(self):
+        # Batches inherit this order, letting plans be built in a single pass.
+        self.registers = dict(sorted(self.registers.items(), key=lambda kv: kv[1][0]))
+        self._batches = {}
 
-        return results
+        for k, v in self.registers.items():
+            self._batches.setdefault(v[2], {}).setdefault(v[7], {})[k] = v
+
+        self._plans = {
+            rtype: {
+                batch: self._plan(values) for batch, values in sorted(batches.items())
+            }
+            for rtype, batches in self._batches.items()
+        }
 
 
 class Inverter(APsystems):
 
     def __init__(self, *args, **kwargs):
         self.model = "Inverter"
-        self.wordorder = Endian.BIG
 
         super().__init__(*args, **kwargs)
 
@@ -445,29 +547,46 @@ class Inverter(APsystems):
         }
         # fmt: off
 
+        self._compile_registers()
+
         self.meter_dids = [
             (0x9cfc, 1, RegisterType.HOLDING, RegisterDataType.UINT16, int, "", "", 1),
             (0x9daa, 1, RegisterType.HOLDING, RegisterDataType.UINT16, int, "", "", 1),
         #    (0x9e59, 1, RegisterType.HOLDING, RegisterDataType.UINT16, int, "", "", 1)
         ]
 
+        self._meters = None
+
     def meters(self):
-        meters = [self._read(v) for v in self.meter_dids]
+        # Meters do not come and go at runtime, so only probe for them once.
+        if self._meters is not None:
+            return self._meters
+
+        dids = [self._read_holding_registers(v[0], v[1]) for v in self.meter_dids]
+
+        if None in dids:
+            return {}
 
-        return {
+        self._meters = {
             f"Meter{idx + 1}": Meter(offset=idx, parent=self)
-            for idx, v in enumerate(meters)
-            if v
+            for idx, (data, v) in enumerate(zip(dids, self.meter_dids))
+            if self._decode_value(data, 0, v[1], v[3], v[4])
         }
 
+        return self._meters
+
 
 class Meter(APsystems):
 
     def __init__(self, offset=False, *args, **kwargs):
         self.model = f"Meter{offset + 1}"
-        self.wordorder = Endian.BIG
 
         super().__init__(*args, **kwargs)
 
         self.offset = METER_REGISTER_OFFSETS[offset]
-        self.registers = {}
+        self.set_registers({})
+
+    def set_registers(self, registers):
+        # Addresses are given relative to the first meter.
+        self.registers = {k: (v[0] + self.offset, *v[1:]) for k, v in registers.items()}
+        self._compile_registers()
@@ -0,0 +1,17 @@
+from ecu_modbus.apsystems_modbus import Inverter
+from ecu_modbus.apsystems_modbus import MODBUS_MAX_REGISTERS
+from ecu_modbus.apsystems_modbus import RegisterType
+
+
+def test_inverter_reads_no_more_than_one_request_per_batch():
+    inverter = Inverter(host="127.0.0.1", port=502)
+
+    reads = [
+        (address, length)
+        for plan in inverter._plans[RegisterType.HOLDING].values()
+        for address, length, fields in plan
+    ]
+
+    # One read per batch, as before registers were clustered: 0x9c42+67, 0x9c85+40.
+    assert len(reads) <= 2
+    assert all(length <= MODBUS_MAX_REGISTERS for address, length in reads)